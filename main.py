@@ -1,31 +1,187 @@
 import os
 import logging
-from aiogram import Bot, Dispatcher, types
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command, CommandStart
-from aiogram.types import Message, BotCommand, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-import requests
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.types import Message, BotCommand, ReplyKeyboardMarkup, KeyboardButton
+import aiohttp
+from aiohttp import web
+import orjson
 from dotenv import load_dotenv
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 import asyncio
-from datetime import datetime
-import pytz
+import hashlib
+import random
+import re
+import time
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
+# Configure logging: records are queued and written to stderr by a background thread
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(log_queue, log_handler)
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[QueueHandler(log_queue)],
     level=logging.INFO
 )
+logger = logging.getLogger(__name__)
 
 # Get environment variables
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 OPENWEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY')
 
-# Initialize bot and dispatcher
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+# Webhook settings; without a public host the bot falls back to long polling
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST') or os.getenv('RENDER_EXTERNAL_HOSTNAME')
+WEBHOOK_PATH = '/tg'
+# The /tg endpoint must never accept unsigned updates: without WEBHOOK_SECRET a secret is
+# derived from the bot token. Telegram only allows A-Z, a-z, 0-9, "_" and "-" in it, so any
+# other value (like the base64 one Render generates) is hashed into a valid token
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or f"bot-token:{TELEGRAM_BOT_TOKEN}"
+if not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET):
+    WEBHOOK_SECRET = hashlib.sha256(WEBHOOK_SECRET.encode()).hexdigest()
+PORT = int(os.getenv('PORT', 8080))
+
+def json_dumps(obj):
+    """Serialize an object to a JSON string with orjson."""
+    return orjson.dumps(obj).decode()
+
+# Initialize bot and dispatcher; Bot API payloads are encoded and decoded with orjson
+bot = Bot(
+    token=TELEGRAM_BOT_TOKEN,
+    session=AiohttpSession(json_loads=orjson.loads, json_dumps=json_dumps)
+)
 dp = Dispatcher()
 
+# Shared HTTP session for OpenWeather requests, created in main()
+HTTP: aiohttp.ClientSession = None
+
+# Cache lifetime (seconds) for OpenWeather responses
+GEO_CACHE_TTL = 30 * 24 * 60 * 60
+GEO_MISS_CACHE_TTL = 24 * 60 * 60
+WEATHER_CACHE_TTL = 10 * 60
+AIR_CACHE_TTL = 60 * 60
+CACHE_MAX_SIZE = 1000
+
+# url -> (expires_at, data)
+_cache = {}
+
+# normalized city -> (expires_at, (lat, lon) or None); expiry is wall-clock time
+# because the cache is saved to GEO_CACHE_FILE on shutdown and loaded on startup
+_geo_cache = {}
+GEO_CACHE_MAX_SIZE = 10000
+GEO_CACHE_FILE = os.getenv('GEO_CACHE_FILE', 'geo_cache.json')
+
+# key -> pending fetch shared by concurrent callers
+_inflight = {}
+
+# user id -> expires_at for users who sent /compare and haven't sent their pair of cities yet
+compare_pending = {}
+COMPARE_PENDING_TTL = 5 * 60
+COMPARE_PENDING_MAX_SIZE = 10000
+
+# Upper bound on simultaneous OpenWeather requests so bursts don't trip its rate limit
+OWM_MAX_CONCURRENCY = 20
+owm_semaphore = asyncio.Semaphore(OWM_MAX_CONCURRENCY)
+
+# Retries after a 429, a 5xx or a dropped connection, waiting about 0.15, 0.3 and 0.6 seconds;
+# all attempts of one fetch together must finish within OWM_FETCH_DEADLINE seconds
+OWM_MAX_RETRIES = 3
+OWM_RETRY_BASE_DELAY = 0.15
+OWM_FETCH_DEADLINE = 8
+
+# Telegram flood limits: 30 messages per second bot-wide, 1 per second in a chat, 20 per minute in a group
+TELEGRAM_RATE_LIMIT = 30
+CHAT_RATE_LIMIT = 1
+GROUP_RATE_LIMIT = 20
+CHAT_LIMITERS_MAX_SIZE = 10000
+
+# Plain-text message that looks like a city name
+CITY_RE = re.compile(r"[\w\s.'’()-]{1,60}")
+
+# Geocoding query: a city name optionally followed by ",country" or ",state,country";
+# anything else (emoji, links, overlong text) is rejected before calling the API
+GEOCODE_QUERY_RE = re.compile(r"[\w\s.,'’()-]{1,100}")
+
+# Compass points for wind direction, 45° apart starting from north
+WIND_DIRECTIONS = ('С', 'СВ', 'В', 'ЮВ', 'Ю', 'ЮЗ', 'З', 'СЗ')
+
+# Message templates
+START_TEXT = (
+    'Привет! Я бот прогноза погоды. 🌤\n'
+    'Я могу:\n'
+    '1. Показать текущую погоду (просто напишите город)\n'
+    '2. Прогноз на 5 дней (/forecast город)\n'
+    '3. Подробную информацию о погоде (/detailed город)\n'
+    '4. Качество воздуха (/air город)\n'
+    '5. Определить погоду по геолокации\n'
+    '6. Сравнить погоду в разных городах (/compare)\n\n'
+    'Используйте кнопку ниже, чтобы отправить свою геолокацию!'
+)
+HELP_TEXT = (
+    'Доступные команды:\n\n'
+    '1. Напишите название города для текущей погоды\n'
+    '2. /forecast ГОРОД - прогноз на 5 дней\n'
+    '3. /detailed ГОРОД - подробная информация\n'
+    '4. /air ГОРОД - качество воздуха\n'
+    '5. /compare - сравнить погоду в городах\n'
+    '6. Нажмите кнопку "📍 Отправить геолокацию" для погоды в вашем месте\n\n'
+    'Примеры:\n'
+    '- "Москва" - текущая погода\n'
+    '- "/forecast Париж" - прогноз на 5 дней\n'
+    '- "/detailed Лондон" - подробная информация'
+)
+DETAILED_TEMPLATE = (
+    "🌍 Подробная информация о погоде в городе {city}:\n\n"
+    "🌡 Температура: {temp:.1f}°C\n"
+    "🤔 Ощущается как: {feels_like:.1f}°C\n"
+    "☁️ Условия: {description}\n"
+    "💧 Влажность: {humidity}%\n"
+    "💨 Ветер: {wind_speed} м/с, направление: {wind_direction}\n"
+    "🌅 Восход: {sunrise}\n"
+    "🌇 Закат: {sunset}\n"
+    "🌡 Давление: {pressure} гПа\n"
+    "👁 Видимость: {visibility:.1f} км\n"
+    "☁️ Облачность: {clouds}%"
+)
+WEATHER_SUMMARY_TEMPLATE = (
+    "{header}:\n"
+    "🌡 Температура: {temp:.1f}°C\n"
+    "🤔 Ощущается как: {feels_like:.1f}°C\n"
+    "☁️ Условия: {description}\n"
+    "💧 Влажность: {humidity}%\n"
+    "💨 Скорость ветра: {wind_speed} м/с\n\n"
+)
+AIR_QUALITY_TEMPLATE = (
+    "🌬 Качество воздуха в городе {city}:\n\n"
+    "Общий индекс: {aqi_level}\n\n"
+    "Компоненты:\n"
+    "CO (Угарный газ): {co:.1f} мкг/м³\n"
+    "NO (Оксид азота): {no:.1f} мкг/м³\n"
+    "NO₂ (Диоксид азота): {no2:.1f} мкг/м³\n"
+    "O₃ (Озон): {o3:.1f} мкг/м³\n"
+    "SO₂ (Диоксид серы): {so2:.1f} мкг/м³\n"
+    "PM2.5 (Мелкие частицы): {pm2_5:.1f} мкг/м³\n"
+    "PM10 (Крупные частицы): {pm10:.1f} мкг/м³"
+)
+
+# AQI levels description
+AQI_LEVELS = {
+    1: "Отличное 😊",
+    2: "Хорошее 🙂",
+    3: "Умеренное 😐",
+    4: "Плохое 😷",
+    5: "Очень плохое 🤢"
+}
+
 # Bot commands for menu
 COMMANDS = [
     BotCommand(command='start', description='Запустить бота'),
@@ -36,6 +192,49 @@ COMMANDS = [
     BotCommand(command='compare', description='Сравнить погоду в двух городах')
 ]
 
+class TokenBucket:
+    """Async token bucket allowing `rate` acquisitions per `period` seconds."""
+
+    def __init__(self, rate, period=1.0):
+        self.capacity = rate
+        self.tokens = rate
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and take it."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+
+# Outgoing message limiters: bot-wide and per chat
+telegram_limiter = TokenBucket(TELEGRAM_RATE_LIMIT)
+chat_limiters = {}
+
+async def safe_answer(message, text, **kwargs):
+    """Reply to a message without exceeding Telegram's flood limits."""
+    chat_id = message.chat.id
+    limiter = chat_limiters.get(chat_id)
+    if limiter is None:
+        # Forget the oldest chat once the table is full
+        if len(chat_limiters) >= CHAT_LIMITERS_MAX_SIZE:
+            chat_limiters.pop(next(iter(chat_limiters)))
+        if message.chat.type in ('group', 'supergroup'):
+            limiter = TokenBucket(GROUP_RATE_LIMIT, 60)
+        else:
+            limiter = TokenBucket(CHAT_RATE_LIMIT)
+        chat_limiters[chat_id] = limiter
+    await limiter.acquire()
+    await telegram_limiter.acquire()
+    return await message.answer(text, **kwargs)
+
 def create_main_keyboard():
     """Create main keyboard with location button."""
     keyboard = ReplyKeyboardMarkup(
@@ -47,25 +246,167 @@ def create_main_keyboard():
     )
     return keyboard
 
+# The reply keyboard never changes, so it's built once and reused for every reply
+MAIN_KEYBOARD = create_main_keyboard()
+
+def norm_city(city):
+    """Normalize a city name for use as a lookup key."""
+    return ' '.join(city.split()).casefold().replace('ё', 'е')
+
+def get_command_city(message):
+    """Return the city passed after a command or None if it's missing."""
+    # The command and its argument are separated by any whitespace, like "/air\nМосква"
+    parts = message.text.split(None, 1)
+    return parts[1].strip() if len(parts) > 1 else None
+
+async def fetch_json(url):
+    """Fetch a URL with the shared HTTP session and decode the JSON body."""
+    async with asyncio.timeout(OWM_FETCH_DEADLINE):
+        for attempt in range(OWM_MAX_RETRIES + 1):
+            last_attempt = attempt == OWM_MAX_RETRIES
+            try:
+                async with owm_semaphore, HTTP.get(url) as response:
+                    if last_attempt or (response.status != 429 and response.status < 500):
+                        response.raise_for_status()
+                        return orjson.loads(await response.read())
+            except aiohttp.ClientConnectionError:
+                if last_attempt:
+                    raise
+
+            # Transient failure: back off exponentially without holding a request slot,
+            # with jitter so requests that failed together don't retry together
+            await asyncio.sleep(OWM_RETRY_BASE_DELAY * 2 ** attempt * (0.5 + random.random()))
+
+async def cached_get(url, ttl):
+    """Fetch JSON from a URL, serving repeated requests from an in-memory TTL cache."""
+    now = time.monotonic()
+    cached = _cache.pop(url, None)
+    if cached and cached[0] > now:
+        _cache[url] = cached
+        return cached[1]
+
+    # Concurrent requests for the same URL share a single upstream fetch
+    return await single_flight(url, lambda: _fetch_and_store(url, ttl))
+
+def single_flight(key, coro_factory):
+    """Run coro_factory() once for all concurrent callers using the same key."""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(coro_factory())
+        task.add_done_callback(lambda done: _forget_inflight(key, done))
+        _inflight[key] = task
+    return asyncio.shield(task)
+
+async def _fetch_and_store(url, ttl):
+    """Fetch a URL and put the result into the response cache."""
+    data = await fetch_json(url)
+
+    # Evict the oldest entry once the cache is full
+    if len(_cache) >= CACHE_MAX_SIZE:
+        _cache.pop(next(iter(_cache)))
+    _cache[url] = (time.monotonic() + ttl, data)
+    return data
+
+def _forget_inflight(key, task):
+    """Drop a finished fetch from the in-flight map."""
+    _inflight.pop(key, None)
+    # Retrieve the exception so it isn't reported when every caller went away
+    if not task.cancelled():
+        task.exception()
+
+async def geocode(city):
+    """Return (lat, lon) for the city or None if it can't be found."""
+    # Emoji, links and overlong text can't be a city, so don't spend an API call on them
+    if not GEOCODE_QUERY_RE.fullmatch(city):
+        return None
+
+    # Normalize the name so "Королёв" and " королев " share one cache entry
+    key = norm_city(city)
+    cached = _geo_cache.pop(key, None)
+    if cached and cached[0] > time.time():
+        _geo_cache[key] = cached
+        return cached[1]
+
+    return await single_flight(f"geo:{key}", lambda: _fetch_coords(key, city))
+
+async def _fetch_coords(key, city):
+    """Look up city coordinates and put them into the geocoding cache under key."""
+    geo_url = f"https://api.openweathermap.org/geo/1.0/direct?q={' '.join(city.split())}&limit=1&appid={OPENWEATHER_API_KEY}"
+    geo_data = await fetch_json(geo_url)
+    coords = (geo_data[0]['lat'], geo_data[0]['lon']) if geo_data else None
+
+    # Evict the oldest entry once the cache is full
+    if len(_geo_cache) >= GEO_CACHE_MAX_SIZE:
+        _geo_cache.pop(next(iter(_geo_cache)))
+    ttl = GEO_CACHE_TTL if coords else GEO_MISS_CACHE_TTL
+    _geo_cache[key] = (time.time() + ttl, coords)
+    return coords
+
+def load_geo_cache():
+    """Fill the geocoding cache from GEO_CACHE_FILE, skipping expired entries."""
+    try:
+        with open(GEO_CACHE_FILE, 'rb') as f:
+            entries = orjson.loads(f.read())
+    except FileNotFoundError:
+        return
+    except (OSError, orjson.JSONDecodeError):
+        logger.warning("Can't read geocoding cache %s", GEO_CACHE_FILE, exc_info=True)
+        return
+
+    # Parse into a separate dict so a malformed file leaves the cache empty rather than half-filled
+    now = time.time()
+    loaded = {}
+    try:
+        for key, (expires_at, coords) in list(entries.items())[-GEO_CACHE_MAX_SIZE:]:
+            if expires_at > now:
+                if coords:
+                    lat, lon = coords
+                    coords = (float(lat), float(lon))
+                loaded[key] = (expires_at, coords or None)
+    except (AttributeError, TypeError, ValueError):
+        logger.warning("Can't read geocoding cache %s", GEO_CACHE_FILE, exc_info=True)
+        return
+    _geo_cache.update(loaded)
+
+def save_geo_cache():
+    """Write the geocoding cache to GEO_CACHE_FILE."""
+    # Write to a temporary file first so a crash mid-write can't leave a truncated cache
+    tmp_path = f"{GEO_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(_geo_cache))
+        os.replace(tmp_path, GEO_CACHE_FILE)
+    except OSError:
+        logger.warning("Can't write geocoding cache %s", GEO_CACHE_FILE, exc_info=True)
+
+async def get_current_weather(lat, lon):
+    """Return current weather for the given coordinates."""
+    # Round to ~1 km so nearby locations share one cache entry
+    weather_url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat:.2f}&lon={lon:.2f}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
+    return await cached_get(weather_url, WEATHER_CACHE_TTL)
+
+def format_hhmm(timestamp):
+    """Format a Unix timestamp as HH:MM in UTC."""
+    minutes = timestamp // 60 % 1440
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
 def format_detailed_weather(weather_data, city_name):
     """Format detailed weather information."""
     # Basic weather info
-    temp = weather_data['main']['temp']
-    feels_like = weather_data['main']['feels_like']
+    main_data, wind, sys_data = weather_data['main'], weather_data['wind'], weather_data['sys']
+    temp, feels_like = main_data['temp'], main_data['feels_like']
+    humidity, pressure = main_data['humidity'], main_data['pressure']
     description = weather_data['weather'][0]['description']
-    humidity = weather_data['main']['humidity']
-    wind_speed = weather_data['wind']['speed']
-    pressure = weather_data['main']['pressure']
+    wind_speed = wind['speed']
     
-    # Convert sunrise and sunset timestamps to datetime
+    # Convert sunrise and sunset timestamps to the city's local time
     timezone_offset = weather_data['timezone']
-    sunrise_time = datetime.fromtimestamp(weather_data['sys']['sunrise'] + timezone_offset).strftime('%H:%M')
-    sunset_time = datetime.fromtimestamp(weather_data['sys']['sunset'] + timezone_offset).strftime('%H:%M')
+    sunrise_time = format_hhmm(sys_data['sunrise'] + timezone_offset)
+    sunset_time = format_hhmm(sys_data['sunset'] + timezone_offset)
     
     # Calculate wind direction
-    wind_deg = weather_data.get('wind', {}).get('deg', 0)
-    wind_directions = ['С', 'СВ', 'В', 'ЮВ', 'Ю', 'ЮЗ', 'З', 'СЗ']
-    wind_direction = wind_directions[round(wind_deg / 45) % 8]
+    wind_deg = wind.get('deg', 0)
+    wind_direction = WIND_DIRECTIONS[(int(wind_deg) * 8 + 180) // 360 & 7]
     
     # Visibility in kilometers
     visibility = weather_data.get('visibility', 0) / 1000
@@ -73,91 +414,79 @@ def format_detailed_weather(weather_data, city_name):
     # Clouds percentage
     clouds = weather_data['clouds']['all']
     
-    return (
-        f"🌍 Подробная информация о погоде в городе {city_name}:\n\n"
-        f"🌡 Температура: {temp:.1f}°C\n"
-        f"🤔 Ощущается как: {feels_like:.1f}°C\n"
-        f"☁️ Условия: {description}\n"
-        f"💧 Влажность: {humidity}%\n"
-        f"💨 Ветер: {wind_speed} м/с, направление: {wind_direction}\n"
-        f"🌅 Восход: {sunrise_time}\n"
-        f"🌇 Закат: {sunset_time}\n"
-        f"🌡 Давление: {pressure} гПа\n"
-        f"👁 Видимость: {visibility:.1f} км\n"
-        f"☁️ Облачность: {clouds}%"
+    return DETAILED_TEMPLATE.format(
+        city=city_name,
+        temp=temp,
+        feels_like=feels_like,
+        description=description,
+        humidity=humidity,
+        wind_speed=wind_speed,
+        wind_direction=wind_direction,
+        sunrise=sunrise_time,
+        sunset=sunset_time,
+        pressure=pressure,
+        visibility=visibility,
+        clouds=clouds
     )
 
+async def require_city_coords(message, usage_example):
+    """Return (city, lat, lon) for a "/command CITY" message or reply and return None."""
+    city = get_command_city(message)
+    if city is None:
+        await safe_answer(
+            message,
+            "Пожалуйста, укажите город после команды.\n"
+            f"Например: {usage_example}"
+        )
+        return None
+
+    coords = await geocode(city)
+    if coords is None:
+        await safe_answer(message, "Извините, не могу найти такой город. Попробуйте другой.")
+        return None
+
+    lat, lon = coords
+    return city, lat, lon
+
+@dp.message.outer_middleware()
+async def cancel_compare_on_command(handler, message, data):
+    """Drop a pending comparison when the user sends another command."""
+    if message.text and message.text.startswith('/') and message.from_user:
+        compare_pending.pop(message.from_user.id, None)
+    return await handler(message, data)
+
 @dp.message(CommandStart())
 async def start_command(message: Message):
     """Send a message when the command /start is issued."""
-    await message.answer(
-        'Привет! Я бот прогноза погоды. 🌤\n'
-        'Я могу:\n'
-        '1. Показать текущую погоду (просто напишите город)\n'
-        '2. Прогноз на 5 дней (/forecast город)\n'
-        '3. Подробную информацию о погоде (/detailed город)\n'
-        '4. Качество воздуха (/air город)\n'
-        '5. Определить погоду по геолокации\n'
-        '6. Сравнить погоду в разных городах (/compare)\n\n'
-        'Используйте кнопку ниже, чтобы отправить свою геолокацию!',
-        reply_markup=create_main_keyboard()
-    )
+    await safe_answer(message, START_TEXT, reply_markup=MAIN_KEYBOARD)
 
 @dp.message(Command('help'))
+@dp.message(F.text == "ℹ️ Помощь")
 async def help_command(message: Message):
     """Send a message when the command /help is issued."""
-    await message.answer(
-        'Доступные команды:\n\n'
-        '1. Напишите название города для текущей погоды\n'
-        '2. /forecast ГОРОД - прогноз на 5 дней\n'
-        '3. /detailed ГОРОД - подробная информация\n'
-        '4. /air ГОРОД - качество воздуха\n'
-        '5. /compare - сравнить погоду в городах\n'
-        '6. Нажмите кнопку "📍 Отправить геолокацию" для погоды в вашем месте\n\n'
-        'Примеры:\n'
-        '- "Москва" - текущая погода\n'
-        '- "/forecast Париж" - прогноз на 5 дней\n'
-        '- "/detailed Лондон" - подробная информация',
-        reply_markup=create_main_keyboard()
-    )
+    await safe_answer(message, HELP_TEXT, reply_markup=MAIN_KEYBOARD)
 
 @dp.message(Command('detailed'))
 async def detailed_command(message: Message):
     """Get detailed weather information for the specified city."""
     try:
-        city = message.text.split(' ', 1)[1]
-    except IndexError:
-        await message.answer(
-            "Пожалуйста, укажите город после команды.\n"
-            "Например: /detailed Москва"
-        )
-        return
-
-    try:
-        # Get coordinates first
-        geo_url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&limit=1&appid={OPENWEATHER_API_KEY}"
-        geo_response = requests.get(geo_url)
-        geo_data = geo_response.json()
-        
-        if not geo_data:
-            await message.answer("Извините, не могу найти такой город. Попробуйте другой.")
+        # Get the city and its coordinates
+        result = await require_city_coords(message, "/detailed Москва")
+        if result is None:
             return
-            
-        lat = geo_data[0]['lat']
-        lon = geo_data[0]['lon']
+        city, lat, lon = result
         
         # Get detailed weather data
-        weather_url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-        weather_response = requests.get(weather_url)
-        weather_data = weather_response.json()
+        weather_data = await get_current_weather(lat, lon)
         
         # Format and send detailed weather information
         detailed_message = format_detailed_weather(weather_data, city)
-        await message.answer(detailed_message)
+        await safe_answer(message, detailed_message)
         
-    except Exception as e:
-        logging.error(f"Error getting detailed weather: {e}")
-        await message.answer(
+    except Exception:
+        logger.exception("Error getting detailed weather")
+        await safe_answer(
+            message,
             "Извините, произошла ошибка при получении информации о погоде. "
             "Пожалуйста, попробуйте позже."
         )
@@ -166,67 +495,34 @@ async def detailed_command(message: Message):
 async def air_quality_command(message: Message):
     """Get air quality information for the specified city."""
     try:
-        city = message.text.split(' ', 1)[1]
-    except IndexError:
-        await message.answer(
-            "Пожалуйста, укажите город после команды.\n"
-            "Например: /air Москва"
-        )
-        return
-
-    try:
-        # Get coordinates first
-        geo_url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&limit=1&appid={OPENWEATHER_API_KEY}"
-        geo_response = requests.get(geo_url)
-        geo_data = geo_response.json()
-        
-        if not geo_data:
-            await message.answer("Извините, не могу найти такой город. Попробуйте другой.")
+        # Get the city and its coordinates
+        result = await require_city_coords(message, "/air Москва")
+        if result is None:
             return
-            
-        lat = geo_data[0]['lat']
-        lon = geo_data[0]['lon']
+        city, lat, lon = result
         
         # Get air quality data
-        air_url = f"http://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}"
-        air_response = requests.get(air_url)
-        air_data = air_response.json()
+        air_url = f"https://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}"
+        air_data = await cached_get(air_url, AIR_CACHE_TTL)
         
-        # AQI levels description
-        aqi_levels = {
-            1: "Отличное 😊",
-            2: "Хорошее 🙂",
-            3: "Умеренное 😐",
-            4: "Плохое 😷",
-            5: "Очень плохое 🤢"
-        }
-        
-        aqi = air_data['list'][0]['main']['aqi']
-        components = air_data['list'][0]['components']
-        
-        air_message = (
-            f"🌬 Качество воздуха в городе {city}:\n\n"
-            f"Общий индекс: {aqi_levels[aqi]}\n\n"
-            f"Компоненты:\n"
-            f"CO (Угарный газ): {components['co']:.1f} мкг/м³\n"
-            f"NO (Оксид азота): {components['no']:.1f} мкг/м³\n"
-            f"NO₂ (Диоксид азота): {components['no2']:.1f} мкг/м³\n"
-            f"O₃ (Озон): {components['o3']:.1f} мкг/м³\n"
-            f"SO₂ (Диоксид серы): {components['so2']:.1f} мкг/м³\n"
-            f"PM2.5 (Мелкие частицы): {components['pm2_5']:.1f} мкг/м³\n"
-            f"PM10 (Крупные частицы): {components['pm10']:.1f} мкг/м³"
+        air = air_data['list'][0]
+        air_message = AIR_QUALITY_TEMPLATE.format(
+            city=city,
+            aqi_level=AQI_LEVELS[air['main']['aqi']],
+            **air['components']
         )
         
-        await message.answer(air_message)
+        await safe_answer(message, air_message)
         
-    except Exception as e:
-        logging.error(f"Error getting air quality: {e}")
-        await message.answer(
+    except Exception:
+        logger.exception("Error getting air quality")
+        await safe_answer(
+            message,
             "Извините, произошла ошибка при получении данных о качестве воздуха. "
             "Пожалуйста, попробуйте позже."
         )
 
-@dp.message(lambda message: message.location is not None)
+@dp.message(F.location)
 async def handle_location(message: Message):
     """Handle received location."""
     try:
@@ -234,88 +530,107 @@ async def handle_location(message: Message):
         lon = message.location.longitude
         
         # Get weather data
-        weather_url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-        weather_response = requests.get(weather_url)
-        weather_data = weather_response.json()
+        weather_data = await get_current_weather(lat, lon)
         
         # Get city name from coordinates
         city_name = weather_data['name']
         
         # Format and send detailed weather information
         detailed_message = format_detailed_weather(weather_data, city_name)
-        await message.answer(detailed_message)
+        await safe_answer(message, detailed_message)
         
-    except Exception as e:
-        logging.error(f"Error handling location: {e}")
-        await message.answer(
+    except Exception:
+        logger.exception("Error handling location")
+        await safe_answer(
+            message,
             "Извините, произошла ошибка при определении погоды по вашей геолокации. "
             "Пожалуйста, попробуйте позже."
         )
 
+async def fetch_city(city):
+    """Return (city, current weather) or (city, None) if the city can't be found."""
+    coords = await geocode(city)
+    if coords is None:
+        return city, None
+
+    lat, lon = coords
+    return city, await get_current_weather(lat, lon)
+
 @dp.message(Command('compare'))
 async def compare_command(message: Message):
     """Start the weather comparison process."""
-    await message.answer(
+    # Forget the oldest pending comparison once the table is full
+    if len(compare_pending) >= COMPARE_PENDING_MAX_SIZE:
+        compare_pending.pop(next(iter(compare_pending)))
+    compare_pending[message.from_user.id] = time.monotonic() + COMPARE_PENDING_TTL
+    await safe_answer(
+        message,
         "Для сравнения погоды в двух городах, отправьте их названия через запятую.\n"
         "Например: Москва, Санкт-Петербург"
     )
 
-@dp.message(lambda message: ',' in message.text)
+def is_compare_pending(message):
+    """Check whether the user sent /compare recently and is expected to send two cities."""
+    expires_at = compare_pending.get(message.from_user.id)
+    if expires_at is None:
+        return False
+    if expires_at <= time.monotonic():
+        del compare_pending[message.from_user.id]
+        return False
+    return True
+
+# Only a recent reply to /compare is treated as a pair of cities
+@dp.message(F.text.contains(',') & ~F.text.startswith('/'), is_compare_pending)
 async def compare_cities(message: Message):
     """Compare weather in two cities."""
     cities = [city.strip() for city in message.text.split(',')]
     if len(cities) != 2:
-        await message.answer("Пожалуйста, укажите ровно два города через запятую.")
+        await safe_answer(message, "Пожалуйста, укажите ровно два города через запятую.")
         return
+    compare_pending.pop(message.from_user.id, None)
 
     try:
-        weather_data = []
-        for city in cities:
-            # Get coordinates
-            geo_url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&limit=1&appid={OPENWEATHER_API_KEY}"
-            geo_response = requests.get(geo_url)
-            geo_data = geo_response.json()
-            
-            if not geo_data:
-                await message.answer(f"Извините, не могу найти город {city}.")
+        # Fetch both cities concurrently
+        results = await asyncio.gather(
+            *(fetch_city(city) for city in cities),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        for city, data in results:
+            if data is None:
+                await safe_answer(message, f"Извините, не могу найти город {city}.")
                 return
-                
-            lat = geo_data[0]['lat']
-            lon = geo_data[0]['lon']
-            
-            # Get weather data
-            weather_url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-            weather_response = requests.get(weather_url)
-            weather_data.append(weather_response.json())
-        
+
         # Compare and format message
-        compare_message = f"🔄 Сравнение погоды:\n\n"
+        parts = ["🔄 Сравнение погоды:\n\n"]
+        temps = []
         
-        for i, data in enumerate(weather_data):
-            temp = data['main']['temp']
-            feels_like = data['main']['feels_like']
-            description = data['weather'][0]['description']
-            humidity = data['main']['humidity']
-            wind_speed = data['wind']['speed']
-            
-            compare_message += (
-                f"📍 {cities[i]}:\n"
-                f"🌡 Температура: {temp:.1f}°C\n"
-                f"🤔 Ощущается как: {feels_like:.1f}°C\n"
-                f"☁️ Условия: {description}\n"
-                f"💧 Влажность: {humidity}%\n"
-                f"💨 Скорость ветра: {wind_speed} м/с\n\n"
-            )
+        for city, data in results:
+            main_data = data['main']
+            temps.append(main_data['temp'])
+            parts.append(WEATHER_SUMMARY_TEMPLATE.format(
+                header=f"📍 {city}",
+                temp=main_data['temp'],
+                feels_like=main_data['feels_like'],
+                description=data['weather'][0]['description'],
+                humidity=main_data['humidity'],
+                wind_speed=data['wind']['speed']
+            ))
         
         # Add temperature difference
-        temp_diff = abs(weather_data[0]['main']['temp'] - weather_data[1]['main']['temp'])
-        compare_message += f"Разница температур: {temp_diff:.1f}°C"
+        temp_diff = abs(temps[0] - temps[1])
+        parts.append(f"Разница температур: {temp_diff:.1f}°C")
+        compare_message = "".join(parts)
         
-        await message.answer(compare_message)
+        await safe_answer(message, compare_message)
         
-    except Exception as e:
-        logging.error(f"Error comparing cities: {e}")
-        await message.answer(
+    except Exception:
+        logger.exception("Error comparing cities")
+        await safe_answer(
+            message,
             "Извините, произошла ошибка при сравнении городов. "
             "Пожалуйста, попробуйте позже."
         )
@@ -324,128 +639,150 @@ async def compare_cities(message: Message):
 async def forecast_command(message: Message):
     """Get 5-day weather forecast for the specified city."""
     try:
-        city = message.text.split(' ', 1)[1]
-    except IndexError:
-        await message.answer(
-            "Пожалуйста, укажите город после команды.\n"
-            "Например: /forecast Москва"
-        )
-        return
-
-    try:
-        # Get coordinates first
-        geo_url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&limit=1&appid={OPENWEATHER_API_KEY}"
-        geo_response = requests.get(geo_url)
-        geo_data = geo_response.json()
-        
-        if not geo_data:
-            await message.answer("Извините, не могу найти такой город. Попробуйте другой.")
+        # Get the city and its coordinates
+        result = await require_city_coords(message, "/forecast Москва")
+        if result is None:
             return
-            
-        lat = geo_data[0]['lat']
-        lon = geo_data[0]['lon']
+        city, lat, lon = result
         
-        # Get 5-day forecast data
-        forecast_url = f"https://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-        forecast_response = requests.get(forecast_url)
-        forecast_data = forecast_response.json()
+        # Get 5-day forecast data; the last entry used is the 33rd, so don't download the rest
+        forecast_url = f"https://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&cnt=33&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
+        forecast_data = await cached_get(forecast_url, WEATHER_CACHE_TTL)
         
         # Process and format forecast data
-        forecast_message = f"🌍 Прогноз погоды в городе {city} на 5 дней:\n\n"
-        
-        # Keep track of processed dates to avoid duplicates
-        processed_dates = set()
+        parts = [f"🌍 Прогноз погоды в городе {city} на 5 дней:\n\n"]
         
-        for item in forecast_data['list']:
-            # Convert timestamp to date
-            date = datetime.fromtimestamp(item['dt'])
-            date_str = date.strftime('%d.%m.%Y')
-            
-            # Only process one forecast per day
-            if date_str in processed_dates:
-                continue
-                
-            processed_dates.add(date_str)
-            
-            # Get weather data
-            temp = item['main']['temp']
-            feels_like = item['main']['feels_like']
-            description = item['weather'][0]['description']
-            humidity = item['main']['humidity']
-            wind_speed = item['wind']['speed']
+        # Entries are 3 hours apart, so every 8th one is the same time on the next day
+        timezone_offset = forecast_data['city']['timezone']
+        for item in forecast_data['list'][::8][:5]:
+            # Convert timestamp to the city's local date
+            date_str = time.strftime('%d.%m.%Y', time.gmtime(item['dt'] + timezone_offset))
             
             # Add day forecast to message
-            forecast_message += (
-                f"📅 {date_str}:\n"
-                f"🌡 Температура: {temp:.1f}°C\n"
-                f"🤔 Ощущается как: {feels_like:.1f}°C\n"
-                f"☁️ Условия: {description}\n"
-                f"💧 Влажность: {humidity}%\n"
-                f"💨 Скорость ветра: {wind_speed} м/с\n\n"
-            )
-            
-            # Stop after 5 days
-            if len(processed_dates) >= 5:
-                break
+            main_data = item['main']
+            parts.append(WEATHER_SUMMARY_TEMPLATE.format(
+                header=f"📅 {date_str}",
+                temp=main_data['temp'],
+                feels_like=main_data['feels_like'],
+                description=item['weather'][0]['description'],
+                humidity=main_data['humidity'],
+                wind_speed=item['wind']['speed']
+            ))
         
-        await message.answer(forecast_message)
+        forecast_message = "".join(parts)
+        await safe_answer(message, forecast_message)
         
-    except Exception as e:
-        logging.error(f"Error getting forecast: {e}")
-        await message.answer(
+    except Exception:
+        logger.exception("Error getting forecast")
+        await safe_answer(
+            message,
             "Извините, произошла ошибка при получении прогноза погоды. "
             "Пожалуйста, попробуйте позже."
         )
 
-@dp.message()
+@dp.message(F.text.regexp(CITY_RE, mode='fullmatch'))
 async def get_weather(message: Message):
     """Get current weather for the specified city."""
-    if message.text == "ℹ️ Помощь":
-        await help_command(message)
-        return
-
     city = message.text
     
     try:
         # Get coordinates first
-        geo_url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&limit=1&appid={OPENWEATHER_API_KEY}"
-        geo_response = requests.get(geo_url)
-        geo_data = geo_response.json()
+        coords = await geocode(city)
         
-        if not geo_data:
-            await message.answer("Извините, не могу найти такой город. Попробуйте другой.")
+        if coords is None:
+            await safe_answer(message, "Извините, не могу найти такой город. Попробуйте другой.")
             return
             
-        lat = geo_data[0]['lat']
-        lon = geo_data[0]['lon']
+        lat, lon = coords
         
         # Get weather data
-        weather_url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-        weather_response = requests.get(weather_url)
-        weather_data = weather_response.json()
+        weather_data = await get_current_weather(lat, lon)
         
         # Format and send detailed weather information
         detailed_message = format_detailed_weather(weather_data, city)
-        await message.answer(detailed_message)
+        await safe_answer(message, detailed_message)
         
-    except Exception as e:
-        logging.error(f"Error getting weather: {e}")
-        await message.answer(
+    except Exception:
+        logger.exception("Error getting weather")
+        await safe_answer(
+            message,
             "Извините, произошла ошибка при получении прогноза погоды. "
             "Пожалуйста, попробуйте позже."
         )
 
+@dp.message()
+async def unknown_message(message: Message):
+    """Reply to messages that don't look like a city name."""
+    await safe_answer(
+        message,
+        "Пожалуйста, отправьте название города, например: Москва.\n"
+        "Список команд: /help"
+    )
+
 async def set_commands():
     """Set bot commands in the menu."""
     await bot.set_my_commands(COMMANDS)
 
-async def main():
-    """Start the bot."""
+async def on_startup():
+    """Load the geocoding cache, open the shared HTTP session, set bot commands and register the webhook."""
+    global HTTP
+    load_geo_cache()
+    HTTP = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=200,
+            limit_per_host=32,
+            keepalive_timeout=75,
+            ttl_dns_cache=600,
+            enable_cleanup_closed=True
+        ),
+        timeout=aiohttp.ClientTimeout(total=8, connect=3)
+    )
+
     # Set bot commands
     await set_commands()
-    
-    # Start polling
+
+    if WEBHOOK_HOST:
+        await bot.set_webhook(
+            f"https://{WEBHOOK_HOST}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET
+        )
+
+async def on_shutdown():
+    """Close the shared HTTP session and save the geocoding cache."""
+    await HTTP.close()
+    save_geo_cache()
+
+async def start_polling():
+    """Receive updates with long polling."""
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
+def main():
+    """Start the bot."""
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    if not WEBHOOK_HOST:
+        asyncio.run(start_polling())
+        return
+
+    # Serve Telegram updates from the webhook endpoint
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host='0.0.0.0', port=PORT, access_log=None)
+
 if __name__ == '__main__':
-    asyncio.run(main()) 
\ No newline at end of file
+    # Use the libuv-based event loop where it's available
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    log_listener.start()
+    try:
+        main()
+    finally:
+        log_listener.stop() 
\ No newline at end of file